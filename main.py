@@ -1,48 +1,359 @@
 import streamlit as st
-from openai import OpenAI
-import PyPDF2
-import docx
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+import asyncio
+import difflib
+import functools
+import hashlib
+import importlib.util
+import inspect
+import io
+import itertools
+import json
+import os
 import re
+import shutil
+import sqlite3
+import subprocess
 import textwrap
+import threading
+import time
+import zipfile
+from collections import Counter
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+from lxml import etree
+
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
+
+try:
+    import pypdfium2
+except ImportError:
+    pypdfium2 = None
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Pick the fastest PDF parser available on this deployment: poppler's
+# pdftotext binary, then PyMuPDF, then PDFium, then pure-Python PyPDF2.
+if shutil.which("pdftotext"):
+    _PDF_BACKEND = "pdftotext"
+elif pymupdf is not None:
+    _PDF_BACKEND = "pymupdf"
+elif pypdfium2 is not None:
+    _PDF_BACKEND = "pdfium"
+else:
+    _PDF_BACKEND = "pypdf2"
+
+# MuPDF (initialized single-threaded by pymupdf) and PDFium are not
+# thread-safe, and both uploads are extracted in parallel; each library is
+# only used under its lock.
+_MUPDF_LOCK = threading.Lock()
+_PDFIUM_LOCK = threading.Lock()
+
+# Chat model for every review/compare prompt; override with REVIEW_MODEL.
+MODEL = os.getenv("REVIEW_MODEL", "gpt-4o-mini")
+# Stronger model for low-confidence or substantive first answers.
+ESCALATION_MODEL = os.getenv("ESCALATION_MODEL", "gpt-4")
+# Prompts shorter than this are answered by MODEL alone.
+SHORT_PROMPT_CHARS = 1500
+# Characters of each document the approval prompt can use.
+MAX_CHARS = 3000
+# Characters of raw text shown in the document previews.
+PREVIEW_CHARS = 1500
+# PDF pages whose content streams exceed this many bytes are checked for
+# fonts before extraction; font-less pages that size are pure graphics.
+MAX_PAGE_STREAM_BYTES = 2_000_000
+# Upper bound on chat requests in flight for one comparison.
+MAX_CONCURRENT_REQUESTS = 8
+# Long comparisons with at most FUSED_MAX_PAIRS changed section pairs go out
+# as one prompt; more are compared PAIRS_PER_CALL pairs per prompt and then
+# reduced by a synthesis call.
+FUSED_MAX_PAIRS = 3
+PAIRS_PER_CALL = 4
+# Context windows (tokens) of the chat models the app may be pointed at;
+# models not listed are assumed to have the smallest.
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4": 8192,
+    "gpt-3.5-turbo": 16385,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+}
+# Tokens of each document one compared section may hold: a group prompt
+# with PAIRS_PER_CALL pairs of them (plus system prompt and reply) must fit
+# MODEL's context.
+SECTION_TOKENS = min(3000, (MODEL_CONTEXT_TOKENS.get(MODEL, 8192) - 2000) // (2 * PAIRS_PER_CALL))
+# Connection pool and per-request timeout of the OpenAI HTTP client.
+HTTP_MAX_CONNECTIONS = 64
+HTTP_MAX_KEEPALIVE = 32
+HTTP_TIMEOUT_SECONDS = 60
+# Pages in pdftotext's first range for prefix reads; each later range doubles.
+PDFTOTEXT_FIRST_BATCH_PAGES = 8
+# On-disk cache of LLM responses; override the location with LLM_CACHE_PATH.
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", ".llm_cache.sqlite3")
 
 # ------------- Text Extraction Utilities -------------
 
-def extract_text_from_pdf(pdf_file):
-    pdf_reader = PyPDF2.PdfReader(pdf_file)
-    text = ""
-    for page in pdf_reader.pages:
-        page_text = page.extract_text() or ""
-        text += page_text + "\n"
-    return text
-
-def extract_text_from_docx(docx_file):
-    d = docx.Document(docx_file)
-    text = ""
-    for p in d.paragraphs:
-        text += p.text + "\n"
-    return text
-
-def extract_text_from_txt(txt_file):
-    content = txt_file.read()
-    if isinstance(content, bytes):
-        return content.decode("utf-8", errors="replace")
-    return str(content)
-
-def get_document_text(uploaded_file):
-    if uploaded_file is None:
+def _pdftotext_pages(data: bytes, first=None, last=None):
+    """
+    Run poppler's pdftotext over the PDF bytes and return its page texts, or
+    None if the tool fails (e.g. encrypted or malformed input, or a first
+    page past the end). first/last bound the 1-based page range.
+    """
+    page_range = []
+    if first is not None:
+        page_range += ["-f", str(first)]
+    if last is not None:
+        page_range += ["-l", str(last)]
+    try:
+        proc = subprocess.run(
+            ["pdftotext", "-enc", "UTF-8", *page_range, "-", "-"],
+            input=data,
+            capture_output=True,
+            check=True,
+            timeout=120,
+        )
+    except (OSError, subprocess.SubprocessError):
         return None
-    if uploaded_file.type == "application/pdf":
-        return extract_text_from_pdf(uploaded_file)
-    elif uploaded_file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-        return extract_text_from_docx(uploaded_file)
-    elif uploaded_file.type == "text/plain":
-        return extract_text_from_txt(uploaded_file)
-    else:
+    # pdftotext ends every page with a form feed
+    pages = proc.stdout.decode("utf-8", errors="replace").split("\f")
+    if pages and not pages[-1]:
+        pages.pop()
+    return pages
+
+def _is_graphics_only_page(doc, page) -> bool:
+    """
+    True for pages with huge content streams and no fonts. They cost the most
+    to interpret yet cannot yield any text. Only inflates the streams and
+    reads the font resources; the content stream itself is never run.
+    """
+    stream_len = sum(len(doc.xref_stream(xref)) for xref in page.get_contents())
+    return stream_len > MAX_PAGE_STREAM_BYTES and not page.get_fonts()
+
+def _pdftotext_page_batches(data: bytes):
+    """
+    Yield page texts from pdftotext in growing page ranges, so a prefix read
+    stops converting once the caller has enough. Returns None if the first
+    batch fails, so the caller can fall back to another backend.
+    """
+    first, size = 1, PDFTOTEXT_FIRST_BATCH_PAGES
+    pages = _pdftotext_pages(data, first, first + size - 1)
+    if pages is None:
+        return None
+    def batches(pages, first, size):
+        while True:
+            yield from pages
+            if len(pages) < size:
+                return
+            first, size = first + size, size * 2
+            pages = _pdftotext_pages(data, first, first + size - 1)
+            # Past the last page (or a later failure): nothing more to read
+            if not pages:
+                return
+    return batches(pages, first, size)
+
+def iter_pdf_text(data: bytes, prefix=False):
+    """
+    Yield the text of each page as it is parsed, so callers that only need
+    a prefix never touch the remaining pages. Pass prefix=True when the
+    caller may stop early, so pdftotext converts page ranges on demand
+    instead of the whole file.
+    """
+    if _PDF_BACKEND == "pdftotext":
+        pages = _pdftotext_page_batches(data) if prefix else _pdftotext_pages(data)
+        if pages is not None:
+            yield from pages
+            return
+    if pymupdf is not None:
+        with _MUPDF_LOCK, pymupdf.open(stream=data, filetype="pdf") as doc:
+            for page in doc:
+                if _is_graphics_only_page(doc, page):
+                    yield ""
+                    continue
+                yield page.get_text("text")
+        return
+    if pypdfium2 is not None:
+        with _PDFIUM_LOCK:
+            try:
+                pdf = pypdfium2.PdfDocument(data)
+            except pypdfium2.PdfiumError:
+                pdf = None
+            if pdf is not None:
+                try:
+                    for page in pdf:
+                        # Close each page even if the caller stops early
+                        try:
+                            textpage = page.get_textpage()
+                            try:
+                                yield textpage.get_text_range()
+                            finally:
+                                textpage.close()
+                        finally:
+                            page.close()
+                finally:
+                    pdf.close()
+                return
+    import PyPDF2
+    for page in PyPDF2.PdfReader(io.BytesIO(data)).pages:
+        yield page.extract_text() or ""
+
+# WordprocessingML run content and its plain-text equivalent (as python-docx
+# renders it); None means "use the element's text".
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_W_RUN_TEXT = {
+    _W + "t": None,
+    _W + "tab": "\t",
+    _W + "ptab": "\t",
+    _W + "cr": "\n",
+    _W + "br": "\n",
+    _W + "noBreakHyphen": "-",
+}
+
+def _paragraph_runs(p):
+    """
+    The paragraph's own runs, directly or inside hyperlinks, as python-docx
+    reads them. Runs nested deeper (text boxes and their VML fallbacks,
+    tracked insertions) are not part of Paragraph.text.
+    """
+    for child in p:
+        if child.tag == _W + "r":
+            yield child
+        elif child.tag == _W + "hyperlink":
+            yield from child.iterchildren(_W + "r")
+
+def iter_docx_text(data: bytes):
+    """
+    Yield the text of each body paragraph, read straight from
+    word/document.xml in one parse instead of through python-docx objects.
+    """
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        root = etree.fromstring(z.read("word/document.xml"))
+    for p in root.find(_W + "body").iterchildren(_W + "p"):
+        parts = []
+        for r in _paragraph_runs(p):
+            for el in r:
+                if el.tag not in _W_RUN_TEXT:
+                    continue
+                if el.tag == _W + "br" and el.get(_W + "type", "textWrapping") != "textWrapping":
+                    continue
+                text = _W_RUN_TEXT[el.tag]
+                parts.append((el.text or "") if text is None else text)
+        yield "".join(parts)
+
+def get_prefix(iterable, n=None):
+    """
+    Join pieces with newlines, stopping once at least n characters have been
+    collected. n=None consumes everything.
+    """
+    parts, total_len = [], 0
+    for part in iterable:
+        parts.append(part)
+        total_len += len(part) + 1
+        if n is not None and total_len >= n:
+            break
+    return "\n".join(parts)
+
+# The extractors take the upload's bytes directly, so they are parsed in
+# memory without further copies.
+
+def extract_text_from_pdf(data: bytes, max_chars=None) -> str:
+    return get_prefix(iter_pdf_text(data, prefix=max_chars is not None), max_chars)
+
+def extract_text_from_docx(data: bytes, max_chars=None) -> str:
+    return get_prefix(iter_docx_text(data), max_chars)
+
+def extract_text_from_txt(data: bytes) -> str:
+    return data.decode("utf-8", errors="replace")
+
+def _dispatch_extract(data: bytes, mime: str, max_chars=None):
+    if mime == "application/pdf":
+        return extract_text_from_pdf(data, max_chars)
+    elif mime == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
+        return extract_text_from_docx(data, max_chars)
+    elif mime == "text/plain":
+        return extract_text_from_txt(data)
+    return None
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _extract_and_normalize(data: bytes, mime: str, max_chars=None):
+    """
+    Raw and normalized text of one upload. Both are pure functions of the
+    bytes, so reruns (button clicks, mode switches) redo neither.
+    """
+    raw = _dispatch_extract(data, mime, max_chars)
+    if raw is None:
+        return None, None
+    return raw, normalize_content(raw)
+
+def get_document(uploaded_file, max_chars=None):
+    """
+    Return (raw, normalized) text of an upload, or (None, None) if it
+    can't be read.
+    """
+    if uploaded_file is None:
+        return None, None
+    raw, norm = _extract_and_normalize(uploaded_file.getvalue(), uploaded_file.type, max_chars)
+    if raw is None:
         st.error("Unsupported file type. Please upload PDF, DOCX, or TXT files.")
+    return raw, norm
+
+def upload_digest(uploaded_file) -> bytes:
+    """Content hash of an upload, for keying per-document-pair state."""
+    return hashlib.blake2b(uploaded_file.getvalue(), digest_size=16).digest()
+
+def get_documents(file1, file2, max_chars=None):
+    """
+    Extract both uploads concurrently. The workers inherit the script run
+    context so caching and st.error keep working inside them.
+    """
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=2, initializer=add_script_run_ctx, initargs=(None, ctx)) as ex:
+        f1 = ex.submit(get_document, file1, max_chars)
+        f2 = ex.submit(get_document, file2, max_chars)
+        return f1.result(), f2.result()
+
+# ------------- Token Counting -------------
+
+@functools.lru_cache(maxsize=None)
+def _encoding():
+    """
+    tiktoken encoding for MODEL, or None when tiktoken or its encoding
+    files are unavailable (they are downloaded on first use).
+    """
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(MODEL)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception:
         return None
 
+def count_tokens(text: str) -> int:
+    """Token count of text for MODEL; about 4 characters a token without tiktoken."""
+    enc = _encoding()
+    if enc is None:
+        return (len(text) + 3) // 4
+    return len(enc.encode_ordinary(text))
+
+def fits_context(model: str, prompt_tokens: int, max_tokens: int) -> bool:
+    return prompt_tokens + max_tokens <= MODEL_CONTEXT_TOKENS.get(model, 8192)
+
 # ------------- Normalization for Content-only Compare -------------
 
+_WS_RE = re.compile(r"[ \t]+")
+# Repeats that mark a short line as page header/footer noise; texts with
+# fewer lines than this cannot have any.
+NOISE_MIN_REPEATS = 5
+
 def normalize_content(text: str) -> str:
     """
     Normalize text to focus on content, not styling/formatting.
@@ -57,111 +368,555 @@ def normalize_content(text: str) -> str:
     t = text.replace("\r\n", "\n").replace("\r", "\n")
     # Remove obvious page headers/footers if repetitive lines appear > 5 times
     lines = [ln.strip() for ln in t.split("\n")]
-    freq = {}
+    common_noise = set()
+    if len(lines) >= NOISE_MIN_REPEATS:
+        freq = Counter(filter(None, lines))
+        common_noise = {ln for ln, c in freq.items() if c >= NOISE_MIN_REPEATS and len(ln) <= 80}
+    # One pass over the lines: drop the noise, keep at most one blank line in
+    # a row, and collapse runs of spaces/tabs inside lines that have them
+    out = []
+    blank = False
     for ln in lines:
         if not ln:
+            if not blank:
+                out.append("")
+                blank = True
             continue
-        freq[ln] = freq.get(ln, 0) + 1
-    common_noise = {ln for ln, c in freq.items() if c >= 5 and len(ln) <= 80}
-    lines = [ln for ln in lines if ln not in common_noise]
-    t = "\n".join(lines)
-    # Collapse excessive whitespace
-    t = re.sub(r"[ \t]+", " ", t)
-    # Collapse multiple blank lines
-    t = re.sub(r"\n{3,}", "\n\n", t)
+        if ln in common_noise:
+            continue
+        blank = False
+        if "  " in ln or "\t" in ln:
+            ln = _WS_RE.sub(" ", ln)
+        out.append(ln)
     # Trim
-    t = t.strip()
-    return t
+    return "\n".join(out).strip()
 
-def chunk_text(s: str, max_chars: int = 6000):
+def chunk_text(s: str, max_tokens: int = SECTION_TOKENS):
     """
     Chunk text on paragraph boundaries to stay within model limits.
+    Paragraphs over max_tokens are split on lines, and lines over it near
+    equal-sized word boundaries.
     """
-    if len(s) <= max_chars:
+    if count_tokens(s) <= max_tokens:
         return [s]
-    paras = s.split("\n\n")
-    chunks, cur, cur_len = [], [], 0
-    for p in paras:
-        if cur_len + len(p) + 2 <= max_chars:
-            cur.append(p)
-            cur_len += len(p) + 2
+    # Track each chunk as a span of s and slice once at the end; a chunk of
+    # consecutive pieces is exactly the text between their offsets
+    spans = []
+    start = end = None
+    cur_tokens = 0
+    for a, b, n in _text_pieces(s, max_tokens):
+        if start is not None and cur_tokens + n + 1 > max_tokens:
+            spans.append((start, end))
+            start, cur_tokens = None, 0
+        if start is None:
+            start = a
+        end = b
+        cur_tokens += n + 1
+    if start is not None:
+        spans.append((start, end))
+    return [s[a:b] for a, b in spans if b > a]
+
+def _text_pieces(s: str, max_tokens: int):
+    """
+    Yield (start, end, tokens) for the paragraphs of s, or for the lines of
+    a paragraph too big to fit max_tokens, or for slices of such a line.
+    """
+    offset = 0
+    for p in s.split("\n\n"):
+        n = count_tokens(p)
+        if n <= max_tokens:
+            yield offset, offset + len(p), n
         else:
-            chunks.append("\n\n".join(cur))
-            cur = [p]
-            cur_len = len(p) + 2
-    if cur:
-        chunks.append("\n\n".join(cur))
-    return chunks
+            o = offset
+            for ln in p.split("\n"):
+                yield from _line_pieces(ln, o, max_tokens)
+                o += len(ln) + 1
+        offset += len(p) + 2
+
+def _line_pieces(ln: str, offset: int, max_tokens: int):
+    n = count_tokens(ln)
+    if n <= max_tokens:
+        yield offset, offset + len(ln), n
+        return
+    # Cut into k slices of about n/k tokens, each ending at a space if any
+    k = -(-n // max_tokens)
+    size = -(-len(ln) // k)
+    a = 0
+    while a < len(ln):
+        b = min(a + size, len(ln))
+        if b < len(ln):
+            space = ln.rfind(" ", a + 1, b)
+            if space > a:
+                b = space
+        yield offset + a, offset + b, count_tokens(ln[a:b])
+        a = b
+# ------------- Pre-screen for Near-identical Content -------------
+
+# Tokens for the pre-screen: numbers with their separators kept whole
+# (1,000 vs 1.000), words, and single symbols ($, €, ≤, +, -, %, ...).
+_TOKEN_RE = re.compile(r"\d+(?:[.,]\d+)*|\w+|[^\w\s]")
+# Sentence punctuation the pre-screen ignores; every other symbol counts.
+_IGNORED_PUNCTUATION = frozenset(".,;:!?'\"()‘’“”")
+# Lines (and characters per line) of unified diff quoted in a pre-screened
+# report.
+DIFF_SNIPPET_LINES = 20
+DIFF_LINE_CHARS = 200
+
+def _prescreen_tokens(text: str):
+    return [t for t in _TOKEN_RE.findall(text.lower()) if t not in _IGNORED_PUNCTUATION]
+
+def prescreen_compare(doc1_norm: str, doc2_norm: str):
+    """
+    Decide trivial comparisons without the LLM. Returns a report in the
+    COMPARE_SYSTEM_PROMPT format when the documents are identical or have
+    the same words, numbers and symbols in the same order (only case,
+    sentence punctuation or whitespace differ), else None. Any other change
+    goes to the model.
+    """
+    if doc1_norm == doc2_norm:
+        return """Decision: IDENTICAL IN MEANING
+Confidence: HIGH
+
+Reasoning:
+- After normalization the two documents contain exactly the same text.
+
+Key Differences (if any):
+- None
+"""
+    w1 = _prescreen_tokens(doc1_norm)
+    if not w1 or w1 != _prescreen_tokens(doc2_norm):
+        return None
+    diff = [
+        ln for ln in difflib.unified_diff(
+            doc1_norm.splitlines(), doc2_norm.splitlines(), "Text A", "Text B", n=0, lineterm=""
+        )
+        if ln[:1] in "+-" and ln[:3] not in ("---", "+++")
+    ]
+    snippet = "\n".join(
+        textwrap.shorten(ln, DIFF_LINE_CHARS, placeholder=" ...") for ln in diff[:DIFF_SNIPPET_LINES]
+    ) or "(line-break changes only)"
+    return f"""Decision: MINOR EDITS ONLY
+Confidence: HIGH
+
+Reasoning:
+- Both documents have the same {len(w1)} words, numbers and symbols in the same order.
+- Only case, sentence punctuation or whitespace differ.
+
+Key Differences (if any):
+```diff
+{snippet}
+```
+"""
+
+# ------------- Section Alignment -------------
+
+# Characters of an inserted/deleted line quoted in the synthesis prompt,
+# and tokens all such quotes may take; lines past that are only counted.
+EVIDENCE_CHARS = 300
+EVIDENCE_TOKENS = SECTION_TOKENS
+
+def align_sections(doc1_norm: str, doc2_norm: str, max_tokens: int = SECTION_TOKENS):
+    """
+    Align two normalized documents line by line with difflib. A line is a
+    paragraph for DOCX/TXT but one visual line of PDF text.
+    Returns (pairs, evidence, unchanged): (Text A, Text B) pairs of changed
+    passages packed up to max_tokens a side, bullets for lines present in
+    only one document (about EVIDENCE_TOKENS of them, then a count of the
+    rest), and the number of lines common to both.
+    """
+    # Blank separators would be the most common element and make matching
+    # super-linear; they carry no content, so match the other lines only
+    l1 = [ln for ln in doc1_norm.split("\n") if ln]
+    l2 = [ln for ln in doc2_norm.split("\n") if ln]
+    pairs, evidence, unchanged = [], [], 0
+    cur1, cur2, tok1, tok2 = [], [], 0, 0
+    evidence_tokens = 0
+    omitted = {"Document 1": 0, "Document 2": 0}
+
+    def flush():
+        nonlocal tok1, tok2
+        if cur1 or cur2:
+            pairs.append(("\n".join(cur1), "\n".join(cur2)))
+        cur1.clear()
+        cur2.clear()
+        tok1 = tok2 = 0
+
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, l1, l2, autojunk=False).get_opcodes():
+        if tag == "equal":
+            unchanged += i2 - i1
+            continue
+        if tag in ("delete", "insert"):
+            side, lines = ("Document 1", l1[i1:i2]) if tag == "delete" else ("Document 2", l2[j1:j2])
+            for ln in lines:
+                if evidence_tokens > EVIDENCE_TOKENS:
+                    omitted[side] += 1
+                    continue
+                bullet = f"- Only in {side}: " + textwrap.shorten(ln, EVIDENCE_CHARS, placeholder=" ...")
+                evidence.append(bullet)
+                evidence_tokens += count_tokens(bullet) + 1
+            continue
+        # Pack neighbouring changes into one pair while both sides still fit,
+        # taking the replaced lines of each side in step
+        for a, b in itertools.zip_longest(l1[i1:i2], l2[j1:j2], fillvalue=""):
+            n1 = count_tokens(a) + 1 if a else 0
+            n2 = count_tokens(b) + 1 if b else 0
+            if (cur1 or cur2) and (tok1 + n1 > max_tokens or tok2 + n2 > max_tokens):
+                flush()
+            if a:
+                cur1.append(a)
+                tok1 += n1
+            if b:
+                cur2.append(b)
+                tok2 += n2
+    flush()
+    evidence.extend(f"- ...and {k} more lines only in {side}" for side, k in omitted.items() if k)
+    return pairs, evidence, unchanged
+
+# ------------- LLM Client -------------
+
+# All OpenAI traffic runs on one long-lived asyncio loop in a background
+# thread. Script threads hand it coroutines and wait for the result; the
+# loop outlives reruns, so the async client's connection pool stays valid.
+
+@st.cache_resource
+def _event_loop() -> asyncio.AbstractEventLoop:
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="llm-event-loop", daemon=True).start()
+    return loop
+
+def run_async(coro):
+    """Run a coroutine on the LLM event loop and block until it finishes."""
+    return asyncio.run_coroutine_threadsafe(coro, _event_loop()).result()
+
+def iter_async(agen):
+    """Consume an async generator from a script thread, one item at a time."""
+    loop = _event_loop()
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+        except StopAsyncIteration:
+            return
+
+@st.cache_resource
+def get_openai_client(api_key: str) -> AsyncOpenAI:
+    """
+    One client per API key for the whole server, so its HTTP connection
+    pool (and TLS sessions) survive across reruns and sessions. Concurrent
+    section compares share pooled connections, multiplexed over HTTP/2 when
+    the h2 package is installed.
+    """
+    http_client = DefaultAsyncHttpxClient(
+        http2=importlib.util.find_spec("h2") is not None,
+        limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE),
+        timeout=HTTP_TIMEOUT_SECONDS,
+    )
+    return AsyncOpenAI(api_key=api_key, http_client=http_client)
+
+def _llm_cache_db() -> sqlite3.Connection:
+    # The cache is best-effort: wait briefly for a locked file, then give up
+    conn = sqlite3.connect(LLM_CACHE_PATH, timeout=1)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, created REAL NOT NULL, response TEXT NOT NULL)"
+    )
+    return conn
+
+def _llm_cache_get(key: str, ttl: float):
+    """Cached response for key, or None on a miss or any SQLite error."""
+    try:
+        with closing(_llm_cache_db()) as conn:
+            row = conn.execute(
+                "SELECT response FROM responses WHERE key = ? AND created >= ?", (key, time.time() - ttl)
+            ).fetchone()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+def _llm_cache_put(key: str, response: str, ttl: float):
+    """Store response under key; skipped on any SQLite error."""
+    now = time.time()
+    try:
+        with closing(_llm_cache_db()) as conn, conn:
+            conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, now, response))
+            conn.execute("DELETE FROM responses WHERE created < ?", (now - ttl,))
+    except sqlite3.Error:
+        pass
+
+# In-flight chat calls by cache key, so concurrent identical prompts (a
+# double-click, two sessions on the same pair) share one API call. Only
+# touched from the background event loop.
+_LLM_INFLIGHT = {}
+
+def cached_llm(ttl_days: float = 7):
+    """
+    Persist the text of a chat call in an on-disk SQLite cache, keyed by a
+    SHA-256 of (model, temperature, max_tokens, system_msg, user_msg), so a
+    repeated prompt skips the API round-trip. The wrapped function is called
+    as fn(client, *, model, system_msg, user_msg, max_tokens, temperature)
+    and is either a coroutine returning the text or an async generator
+    yielding it in pieces.
+    A call whose key is already in flight awaits that call instead of
+    making its own; a streaming caller then gets the text in one piece.
+    Failed or abandoned calls are never cached, and cache errors only
+    cost the cache hit: the call itself goes ahead.
+    """
+    ttl = ttl_days * 86400
+
+    def cache_key(model, system_msg, user_msg, max_tokens, temperature):
+        payload = json.dumps([model, temperature, max_tokens, system_msg, user_msg])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def finish(key, fut):
+        if _LLM_INFLIGHT.get(key) is fut:
+            del _LLM_INFLIGHT[key]
+        if not fut.cancelled() and fut.exception() is None:
+            # Cache I/O runs on a worker thread, never on the shared loop
+            fut.get_loop().run_in_executor(None, _llm_cache_put, key, fut.result(), ttl)
+
+    def decorate(fn):
+        if inspect.isasyncgenfunction(fn):
+            @functools.wraps(fn)
+            async def stream_wrapper(client, **params):
+                key = cache_key(**params)
+                hit = await asyncio.to_thread(_llm_cache_get, key, ttl)
+                if hit is None and key in _LLM_INFLIGHT:
+                    try:
+                        hit = await asyncio.shield(_LLM_INFLIGHT[key])
+                    except Exception:
+                        hit = None  # that call failed; make our own
+                if hit is not None:
+                    yield hit
+                    return
+                fut = asyncio.get_running_loop().create_future()
+                fut.add_done_callback(functools.partial(finish, key))
+                _LLM_INFLIGHT[key] = fut
+                parts = []
+                try:
+                    async for piece in fn(client, **params):
+                        parts.append(piece)
+                        yield piece
+                except BaseException as e:
+                    # Failed, or abandoned by the consumer (GeneratorExit)
+                    fut.set_exception(e if isinstance(e, Exception) else RuntimeError("stream abandoned"))
+                    raise
+                fut.set_result("".join(parts))
+            return stream_wrapper
+
+        @functools.wraps(fn)
+        async def wrapper(client, **params):
+            key = cache_key(**params)
+            hit = await asyncio.to_thread(_llm_cache_get, key, ttl)
+            if hit is not None:
+                return hit
+            # Shielded so one caller giving up does not cancel the others
+            if key in _LLM_INFLIGHT:
+                try:
+                    return await asyncio.shield(_LLM_INFLIGHT[key])
+                except Exception:
+                    pass  # that call failed or was abandoned; make our own
+            task = _LLM_INFLIGHT.get(key)
+            if task is None or task.done():
+                task = asyncio.ensure_future(fn(client, **params))
+                task.add_done_callback(functools.partial(finish, key))
+                _LLM_INFLIGHT[key] = task
+            return await asyncio.shield(task)
+        return wrapper
+
+    return decorate
+
+@cached_llm(ttl_days=7)
+async def _chat_completion(client, *, model, system_msg, user_msg, max_tokens, temperature):
+    """Single chat completion; returns the response text. Errors propagate."""
+    response = await client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_msg},
+            {"role": "user", "content": user_msg}
+        ],
+        max_tokens=max_tokens,
+        temperature=temperature,
+    )
+    return response.choices[0].message.content or ""
+
+@cached_llm(ttl_days=7)
+async def _chat_stream(client, *, model, system_msg, user_msg, max_tokens, temperature):
+    """Streaming chat completion; yields response text deltas. Errors propagate."""
+    response = await client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_msg},
+            {"role": "user", "content": user_msg}
+        ],
+        max_tokens=max_tokens,
+        temperature=temperature,
+        stream=True,
+    )
+    async for chunk in response:
+        if chunk.choices:
+            yield chunk.choices[0].delta.content or ""
+
+# Two-tier routing: every prompt goes to MODEL first, and answers that flag
+# themselves "Confidence: LOW" (or, for comparisons, find substantive
+# differences) are re-asked of ESCALATION_MODEL. Prompts shorter than
+# SHORT_PROMPT_CHARS are trivial enough to never escalate.
+_LOW_CONFIDENCE_RE = re.compile(r"^\s*Confidence:\s*LOW\b", re.IGNORECASE | re.MULTILINE)
+_SUBSTANTIVE_RE = re.compile(r"^\s*Decision:\s*SUBSTANTIVE\b", re.IGNORECASE | re.MULTILINE)
+
+def choose_model(prompt_len: int, mode: str, first_answer: str = None) -> str:
+    """
+    Model for a prompt of prompt_len characters in mode "approval" or
+    "compare". Without first_answer this is the first-pass model; given the
+    first-pass answer, it is ESCALATION_MODEL if that answer warrants a
+    second opinion and MODEL otherwise.
+    """
+    if first_answer is None or prompt_len < SHORT_PROMPT_CHARS:
+        return MODEL
+    head = first_answer[:300]
+    if _LOW_CONFIDENCE_RE.search(head):
+        return ESCALATION_MODEL
+    if mode == "compare" and _SUBSTANTIVE_RE.search(head):
+        return ESCALATION_MODEL
+    return MODEL
+
+async def _routed_completion(client, mode, *, system_msg, user_msg, max_tokens, temperature):
+    """
+    _chat_completion through the two-tier router. Prompts too long for
+    the escalation model's context window are not escalated, and if the
+    escalated call fails the first answer stands.
+    """
+    prompt_len = len(system_msg) + len(user_msg)
+    params = dict(system_msg=system_msg, user_msg=user_msg, max_tokens=max_tokens, temperature=temperature)
+    answer = await _chat_completion(client, model=choose_model(prompt_len, mode), **params)
+    model = choose_model(prompt_len, mode, answer)
+    if model == MODEL or not fits_context(model, count_tokens(system_msg + user_msg), max_tokens):
+        return answer
+    try:
+        return await _chat_completion(client, model=model, **params)
+    except Exception:
+        return answer
+
+def _final_report(client, mode, *, system_msg, user_msg, max_tokens, temperature, placeholder=None):
+    """
+    Run the request whose answer is shown to the user through the two-tier
+    router. With a placeholder (an st.empty()) the first answer is written
+    into it with write_stream as it arrives; an escalated answer replaces it
+    once complete. Errors on the first call propagate.
+    """
+    if placeholder is None:
+        return run_async(_routed_completion(
+            client, mode, system_msg=system_msg, user_msg=user_msg, max_tokens=max_tokens, temperature=temperature
+        ))
+    params = dict(system_msg=system_msg, user_msg=user_msg, max_tokens=max_tokens, temperature=temperature)
+    prompt_len = len(system_msg) + len(user_msg)
+    answer = placeholder.write_stream(iter_async(_chat_stream(client, model=choose_model(prompt_len, mode), **params)))
+    if not isinstance(answer, str):
+        answer = "".join(answer)
+    model = choose_model(prompt_len, mode, answer)
+    if model != MODEL and fits_context(model, count_tokens(system_msg + user_msg), max_tokens):
+        try:
+            answer = run_async(_chat_completion(client, model=model, **params))
+            placeholder.markdown(answer)
+        except Exception:
+            pass
+    return answer
 
 # ------------- LLM: Approval Analysis (original) -------------
 
-def analyze_document_approval(client, circular_text, proposal_text):
-    prompt = f"""
-    You are an expert reviewer. Document 1 is an official circular (policy/guideline/communication). Document 2 is a proposal that claims to be based on Document 1.
+# Prompts are split into a fixed system message (instructions and response
+# format, byte-identical on every call) followed by the variable documents,
+# so providers that cache prompt prefixes can reuse the shared part.
+APPROVAL_SYSTEM_PROMPT = """You are an expert reviewer for proposals and circulars, specializing in compliance analysis and approval decisions.
+
+You will be given two documents. Document 1 is an official circular (policy/guideline/communication). Document 2 is a proposal that claims to be based on Document 1.
+
+Your task:
+1. Carefully read both documents.
+2. Decide if the proposal (Document 2) can be approved strictly on the basis of the circular (Document 1).
+3. If it can be approved, state "APPROVED" and briefly explain why.
+4. If it cannot be approved, state "REJECTED" and clearly list the reasons for rejection, referencing specific requirements or gaps.
 
-    Your task:
-    1. Carefully read both documents.
-    2. Decide if the proposal (Document 2) can be approved strictly on the basis of the circular (Document 1).
-    3. If it can be approved, state "APPROVED" and briefly explain why.
-    4. If it cannot be approved, state "REJECTED" and clearly list the reasons for rejection, referencing specific requirements or gaps.
+Please provide your answer in this format:
+Decision: APPROVED/REJECTED
+Confidence: HIGH/LOW (LOW if the documents are ambiguous or you are unsure of the decision)
 
-    Document 1 (Circular):
-    {circular_text[:3000]}
+Explanation:
+(Your detailed reasoning here)
 
-    Document 2 (Proposal):
-    {proposal_text[:3000]}
+Key Points Analysis:
+- Compliance with circular requirements
+- Missing elements (if any)
+- Alignment with stated policies
+- Recommendations for improvement (if rejected)
+"""
 
-    Please provide your answer in this format:
-    Decision: APPROVED/REJECTED
+# The prompt asks for "Decision: APPROVED/REJECTED" up front, so the verdict
+# is the first of the two words near the start of the response.
+_VERDICT_RE = re.compile(r"\b(APPROVED|REJECTED)\b", re.IGNORECASE)
 
-    Explanation:
-    (Your detailed reasoning here)
+def approval_verdict(analysis_result: str):
+    """Return "APPROVED", "REJECTED" or None from the head of the response."""
+    m = _VERDICT_RE.search(analysis_result, 0, 200)
+    return m.group(1).upper() if m else None
 
-    Key Points Analysis:
-    - Compliance with circular requirements
-    - Missing elements (if any)
-    - Alignment with stated policies
-    - Recommendations for improvement (if rejected)
+def analyze_document_approval(client, circular_text, proposal_text, placeholder=None):
+    """
+    Run the approval prompt on the first MAX_CHARS of each document. If
+    placeholder (an st.empty()) is given, the response is streamed into it.
+    Inputs are truncated before the prompt is built, so
+    edits past what the model sees still hit the response cache.
     """
+    circular_text = circular_text[:MAX_CHARS]
+    proposal_text = proposal_text[:MAX_CHARS]
+    # Circular first: repeat checks of different proposals against the same
+    # circular then share an even longer cacheable prefix.
+    prompt = f"""Document 1 (Circular):
+{circular_text}
+
+Document 2 (Proposal):
+{proposal_text}
+"""
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are an expert reviewer for proposals and circulars, specializing in compliance analysis and approval decisions."},
-                {"role": "user", "content": prompt}
-            ],
+        return _final_report(
+            client,
+            "approval",
+            system_msg=APPROVAL_SYSTEM_PROMPT,
+            user_msg=prompt,
             max_tokens=1000,
-            temperature=0.2
+            temperature=0.2,
+            placeholder=placeholder,
         )
-        return response.choices[0].message.content
     except Exception as e:
         return f"Error analyzing documents: {str(e)}"
 
 # ------------- LLM: Content Comparison with Reasoning -------------
 
-def llm_content_compare(client, doc1_norm: str, doc2_norm: str):
-    """
-    Compare content semantically, ignoring styling/formatting. Provide reasoned report.
-    If texts are long, summarize chunks then provide a global judgment.
-    """
-    # Chunk if needed
-    c1 = chunk_text(doc1_norm, max_chars=6000)
-    c2 = chunk_text(doc2_norm, max_chars=6000)
-
-    # If single-chunk each, do a direct compare
-    if len(c1) == 1 and len(c2) == 1:
-        return _llm_direct_compare(client, c1[0], c2[0])
-
-    # Otherwise, compare chunk pairs and then ask the model for an overall synthesis
-    per_chunk_results = []
-    for i in range(max(len(c1), len(c2))):
-        t1 = c1[i] if i < len(c1) else ""
-        t2 = c2[i] if i < len(c2) else ""
-        res = _llm_direct_compare(client, t1, t2, section_label=f"Section {i+1}")
-        per_chunk_results.append(res)
-
-    synthesis_prompt = f"""
-You are comparing two long documents in multiple sections. Below are per-section comparison reports. Produce a single final report that:
+COMPARE_SYSTEM_PROMPT = """You are a rigorous content-comparison expert. Focus only on meaning, not styling or formatting.
+
+You will be given two texts, Text A and Text B. Compare their content, focusing only on meaning/semantics and substantive requirements. Ignore fonts, styles, headings, numbering changes, and superficial formatting.
+
+Long texts are given as numbered sections holding only the passages that changed, with the count of unchanged lines and any lines present in only one document. Judge all sections together and give one overall decision.
+
+Tasks:
+1) Determine if Text B has the same meaning as Text A.
+2) If there are differences, classify them as MINOR EDITS (wording/grammar/ordering with preserved meaning) or SUBSTANTIVE DIFFERENCES (policy, scope, conditions, figures, dates, obligations change).
+3) Provide solid reasoning with specific references (short quotes or paraphrases). Keep it concise but concrete.
+
+Respond in this exact format:
+Decision: IDENTICAL IN MEANING / MINOR EDITS ONLY / SUBSTANTIVE DIFFERENCES
+Confidence: HIGH / LOW (LOW if the texts are ambiguous or you are unsure of the decision)
+
+Reasoning:
+- <bullet points with evidence>
+
+Key Differences (if any):
+- <short snippet or paraphrase comparison>
+
+Recommendations (if any):
+- <how to align B to A if needed>
+"""
+
+SYNTHESIS_SYSTEM_PROMPT = """You are a rigorous content-comparison expert. Focus only on meaning, not styling or formatting.
+
+You are comparing two long documents in multiple sections. Lines that are identical in both documents have already been set aside. You will be given the count of unchanged lines, the lines present in only one document, and per-section comparison reports for the changed passages. Produce a single final report that:
 - Judges whether the documents are identical in meaning, have only minor editorial differences, or contain substantive differences.
 - Explains the key differences with solid reasoning.
 - Lists examples/quotes (short snippets) to illustrate differences (if any).
@@ -172,11 +927,9 @@ Possible Decision values:
 - "MINOR EDITS ONLY"
 - "SUBSTANTIVE DIFFERENCES"
 
-Per-section results:
-{"\n\n".join(per_chunk_results)}
-
 Respond in this exact format:
 Decision: <one of the three values>
+Confidence: HIGH / LOW (LOW if the section reports conflict or you are unsure of the decision)
 
 Reasoning:
 - <bullet 1>
@@ -189,59 +942,170 @@ Key Differences (if any):
 Recommendations (if any):
 - <how to align them or what to change>
 """
+
+# First "Decision:" line of a report, found without splitting it into lines
+_DECISION_RE = re.compile(r"^\s*Decision:\s*(.+)$", re.IGNORECASE | re.MULTILINE)
+_DECISIONS = {
+    "IDENTICAL": "IDENTICAL IN MEANING",
+    "MINOR": "MINOR EDITS ONLY",
+    "SUBSTANTIVE": "SUBSTANTIVE DIFFERENCES",
+}
+
+def compare_decision(report: str):
+    """Return the report's Decision value (one of the three), or None."""
+    m = _DECISION_RE.search(report)
+    if m:
+        value = m.group(1).upper()
+        for key, decision in _DECISIONS.items():
+            if key in value:
+                return decision
+    return None
+
+def llm_content_compare(client, doc1_norm: str, doc2_norm: str, placeholder=None):
+    """
+    Compare content semantically, ignoring styling/formatting. Provide reasoned report.
+    If texts are long, compare the changed sections in groups then provide a
+    global judgment. If placeholder (an st.empty()) is given, the final
+    report is streamed into it.
+    """
+    report, final = _prepare_content_compare(client, doc1_norm, doc2_norm)
+    if report is not None:
+        if placeholder is not None:
+            placeholder.markdown(report)
+        return report
+    system_msg, user_msg, error = final
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are a rigorous content-comparison expert. Focus only on meaning, not styling or formatting."},
-                {"role": "user", "content": synthesis_prompt}
-            ],
+        return _final_report(
+            client,
+            "compare",
+            system_msg=system_msg,
+            user_msg=user_msg,
             max_tokens=800,
             temperature=0.1,
+            placeholder=placeholder,
         )
-        return response.choices[0].message.content
     except Exception as e:
-        return f"Error during content comparison synthesis: {str(e)}"
+        return f"{error}: {str(e)}"
 
-def _llm_direct_compare(client, t1: str, t2: str, section_label: str = None):
-    section = f" ({section_label})" if section_label else ""
-    prompt = f"""
-Compare the content of two texts{section}. Focus only on meaning/semantics and substantive requirements. Ignore fonts, styles, headings, numbering changes, and superficial formatting.
+def _prepare_content_compare(client, doc1_norm: str, doc2_norm: str):
+    """
+    Everything up to the request for the final report. Returns (report, None)
+    when no further call is needed, else (None, (system_msg, user_msg,
+    error prefix)) for the final request. The CPU-bound steps run here on
+    the script thread; only the group compares go to the shared event loop.
+    """
+    # Identical or trivially-edited documents need no model call
+    report = prescreen_compare(doc1_norm, doc2_norm)
+    if report is not None:
+        return report, None
 
-Text A:
-{t1}
+    # If each document fits one section, do a direct compare
+    if count_tokens(doc1_norm) <= SECTION_TOKENS and count_tokens(doc2_norm) <= SECTION_TOKENS:
+        return None, (COMPARE_SYSTEM_PROMPT, _sections_prompt([(doc1_norm, doc2_norm)]), "Error during content comparison")
 
-Text B:
-{t2}
+    # Otherwise, align the documents line by line so an insertion
+    # early on does not shift every later section; only the changed stretches
+    # go to the model
+    pairs, evidence, unchanged = align_sections(doc1_norm, doc2_norm)
 
-Tasks:
-1) Determine if Text B has the same meaning as Text A.
-2) If there are differences, classify them as MINOR EDITS (wording/grammar/ordering with preserved meaning) or SUBSTANTIVE DIFFERENCES (policy, scope, conditions, figures, dates, obligations change).
-3) Provide solid reasoning with specific references (short quotes or paraphrases). Keep it concise but concrete.
+    # A few changed pairs fit one prompt that yields the final report directly
+    if len(pairs) <= FUSED_MAX_PAIRS:
+        prompt = _sections_prompt(pairs, evidence=evidence, unchanged=unchanged)
+        return None, (COMPARE_SYSTEM_PROMPT, prompt, "Error during content comparison")
 
-Respond in this exact format:
-Decision: IDENTICAL IN MEANING / MINOR EDITS ONLY / SUBSTANTIVE DIFFERENCES
+    # Otherwise, compare groups of pairs concurrently and then ask the model
+    # for an overall synthesis
+    per_chunk_results = run_async(_compare_groups(client, pairs))
+
+    # Groups that agree with no one-sided lines leave nothing to
+    # synthesize; the report is assembled here instead
+    decisions = [compare_decision(r) for r in per_chunk_results]
+    if not evidence and None not in decisions and len(set(decisions)) == 1:
+        return _unanimous_report(decisions[0], per_chunk_results, unchanged), None
+
+    # Sections found identical only need counting
+    changed = [r for r, d in zip(per_chunk_results, decisions) if d != "IDENTICAL IN MEANING"]
+    sections = "\n\n".join(changed)
+    added_removed = "\n".join(evidence) or "- None"
+    synthesis_prompt = f"""Unchanged lines: {unchanged}
+Section groups judged identical in meaning: {len(per_chunk_results) - len(changed)}
+
+Lines present in only one document:
+{added_removed}
+
+Per-section results:
+{sections}
+"""
+    return None, (SYNTHESIS_SYSTEM_PROMPT, synthesis_prompt, "Error during content comparison synthesis")
+
+async def _compare_groups(client, pairs):
+    """
+    Reports for PAIRS_PER_CALL pairs at a time, capped to stay under rate
+    limits.
+    """
+    limit = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    async def compare_group(start):
+        async with limit:
+            return await _llm_sections_compare(client, pairs[start:start + PAIRS_PER_CALL], start=start)
+
+    return await asyncio.gather(
+        *(compare_group(start) for start in range(0, len(pairs), PAIRS_PER_CALL))
+    )
+
+def _unanimous_report(decision: str, group_reports, unchanged: int) -> str:
+    confidence = "LOW" if any(_LOW_CONFIDENCE_RE.search(r) for r in group_reports) else "HIGH"
+    details = "\n\n".join(group_reports)
+    return f"""Decision: {decision}
+Confidence: {confidence}
 
 Reasoning:
-- <bullet points with evidence>
+- All {len(group_reports)} section groups were judged {decision}.
+- {unchanged} lines are unchanged and no line appears in only one document.
 
-Key Differences (if any):
-- <short snippet or paraphrase comparison>
+Section reports:
 
-Recommendations (if any):
-- <how to align B to A if needed>
+{details}
+"""
+
+def _sections_prompt(pairs, start: int = 0, evidence=None, unchanged: int = None) -> str:
+    """
+    User message comparing aligned (Text A, Text B) pairs, numbered from
+    Section start+1. A single unnumbered pair is a plain Text A/Text B
+    prompt.
+    """
+    if len(pairs) == 1 and evidence is None and unchanged is None:
+        t1, t2 = pairs[0]
+        return f"""Text A:
+{t1}
+
+Text B:
+{t2}
 """
+    parts = []
+    if unchanged is not None:
+        parts.append(f"Unchanged lines: {unchanged}")
+    if evidence is not None:
+        added_removed = "\n".join(evidence) or "- None"
+        parts.append(f"Lines present in only one document:\n{added_removed}")
+    for i, (t1, t2) in enumerate(pairs, start + 1):
+        parts.append(f"Section {i}\n\nText A:\n{t1}\n\nText B:\n{t2}")
+    return "\n\n".join(parts) + "\n"
+
+async def _llm_sections_compare(client, pairs, start: int = 0):
+    """
+    Compare a group of aligned pairs in one prompt; the report feeds the
+    synthesis.
+    """
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "You are a rigorous content-comparison expert. Focus only on meaning, not styling or formatting."},
-                {"role": "user", "content": prompt}
-            ],
+        return await _routed_completion(
+            client,
+            "compare",
+            system_msg=COMPARE_SYSTEM_PROMPT,
+            user_msg=_sections_prompt(pairs, start=start),
             max_tokens=800,
             temperature=0.1,
         )
-        return response.choices[0].message.content
     except Exception as e:
         return f"Error during content comparison: {str(e)}"
 
@@ -272,7 +1136,7 @@ def main():
             st.stop()
         api_key = st.secrets["openai"]["api_key"]
         try:
-            client = OpenAI(api_key=api_key)
+            client = get_openai_client(api_key)
         except Exception:
             st.error("Error initializing AI backend. Please contact the administrator.")
             return
@@ -299,66 +1163,97 @@ def main():
             st.success(f"✅ {doc2_file.name} uploaded")
 
     if doc1_file and doc2_file:
+        # Previews only need the first pages, so render them before the full parse
         with st.spinner("Extracting text from documents..."):
-            doc1_text_raw = get_document_text(doc1_file)
-            doc2_text_raw = get_document_text(doc2_file)
+            (doc1_preview, _), (doc2_preview, _) = get_documents(doc1_file, doc2_file, PREVIEW_CHARS)
 
-        if not doc1_text_raw or not doc2_text_raw:
+        if not doc1_preview or not doc2_preview:
             st.error("Failed to extract text from one or both documents.")
             return
 
-        # Previews
         with st.expander("📖 Document Previews (raw extracted text)"):
             c1, c2 = st.columns(2)
             with c1:
                 st.subheader("Document 1")
-                st.text_area("", doc1_text_raw[:1500] + ("..." if len(doc1_text_raw) > 1500 else ""), height=220, disabled=True)
+                st.text_area("Document 1 preview", doc1_preview[:PREVIEW_CHARS] + ("..." if len(doc1_preview) > PREVIEW_CHARS else ""), height=220, disabled=True, label_visibility="collapsed")
             with c2:
                 st.subheader("Document 2")
-                st.text_area("", doc2_text_raw[:1500] + ("..." if len(doc2_text_raw) > 1500 else ""), height=220, disabled=True)
+                st.text_area("Document 2 preview", doc2_preview[:PREVIEW_CHARS] + ("..." if len(doc2_preview) > PREVIEW_CHARS else ""), height=220, disabled=True, label_visibility="collapsed")
+
+        # Approval only ever sends the first MAX_CHARS of each document, so
+        # stop parsing early there; leave headroom for what normalization strips.
+        # Content comparison needs the whole text.
+        max_chars = 2 * MAX_CHARS if mode == "Approval Analyzer" else None
+        with st.spinner("Extracting text from documents..."):
+            (_, doc1_norm), (_, doc2_norm) = get_documents(doc1_file, doc2_file, max_chars)
 
-        # Normalized versions for content-only compare
-        doc1_norm = normalize_content(doc1_text_raw)
-        doc2_norm = normalize_content(doc2_text_raw)
+        # Word/char counts only change with the uploads, so count once per pair.
+        # Approval counts what the model analyzes: the first MAX_CHARS.
+        stats_key = (doc1_file.file_id, doc2_file.file_id, max_chars)
+        if st.session_state.get("stats_key") != stats_key:
+            seen1, seen2 = (doc1_norm[:MAX_CHARS], doc2_norm[:MAX_CHARS]) if max_chars else (doc1_norm, doc2_norm)
+            st.session_state.stats = {
+                "w1": len(seen1.split()),
+                "w2": len(seen2.split()),
+                "c1": len(seen1),
+                "c2": len(seen2),
+            }
+            st.session_state.stats_key = stats_key
+        stats = st.session_state.stats
 
         if mode == "Approval Analyzer":
             if st.button("🔍 Analyze Proposal for Approval", type="primary"):
-                with st.spinner("Analyzing proposal against circular requirements..."):
-                    analysis_result = analyze_document_approval(client, doc1_norm, doc2_norm)
                 st.subheader("🎯 Approval Decision")
-                if "APPROVED" in analysis_result.upper():
-                    st.success("✅ PROPOSAL APPROVED")
-                elif "REJECTED" in analysis_result.upper():
-                    st.error("❌ PROPOSAL REJECTED")
-                st.markdown(analysis_result)
+                verdict_slot = st.empty()
+                result_slot = st.empty()
+                with st.spinner("Analyzing proposal against circular requirements..."):
+                    analysis_result = analyze_document_approval(client, doc1_norm, doc2_norm, placeholder=result_slot)
+                verdict = approval_verdict(analysis_result)
+                if verdict == "APPROVED":
+                    verdict_slot.success("✅ PROPOSAL APPROVED")
+                elif verdict == "REJECTED":
+                    verdict_slot.error("❌ PROPOSAL REJECTED")
+                result_slot.markdown(analysis_result)
 
                 st.subheader("📊 Document Statistics")
                 colA, colB, colC, colD = st.columns(4)
                 with colA:
-                    st.metric("Doc1 Words (normalized)", f"{len(doc1_norm.split())}")
+                    st.metric("Doc1 Words (analyzed)", f"{stats['w1']}")
                 with colB:
-                    st.metric("Doc2 Words (normalized)", f"{len(doc2_norm.split())}")
+                    st.metric("Doc2 Words (analyzed)", f"{stats['w2']}")
                 with colC:
-                    st.metric("Doc1 Characters", f"{len(doc1_norm):,}")
+                    st.metric("Doc1 Characters (analyzed)", f"{stats['c1']:,}")
                 with colD:
-                    st.metric("Doc2 Characters", f"{len(doc2_norm):,}")
+                    st.metric("Doc2 Characters (analyzed)", f"{stats['c2']:,}")
 
         else:  # Content Compare (LLM)
+            # Keep the last report per upload pair so reruns (and repeat
+            # clicks) re-render it instead of re-running the comparison.
+            compare_key = (upload_digest(doc1_file), upload_digest(doc2_file))
+            run = False
             if st.button("🧠 Compare Content (LLM)", type="primary"):
-                with st.spinner("Comparing content with LLM (ignoring styling/formatting)..."):
-                    result = llm_content_compare(client, doc1_norm, doc2_norm)
+                stored = st.session_state.get("_compare_result", "")
+                run = st.session_state.get("_compare_key") != compare_key or stored.startswith("Error")
 
+            if run or st.session_state.get("_compare_key") == compare_key:
                 st.subheader("🧾 LLM Content Comparison Result")
-                st.markdown(result)
+                result_slot = st.empty()
+                if run:
+                    with st.spinner("Comparing content with LLM (ignoring styling/formatting)..."):
+                        st.session_state["_compare_result"] = llm_content_compare(
+                            client, doc1_norm, doc2_norm, placeholder=result_slot
+                        )
+                    st.session_state["_compare_key"] = compare_key
+                result = st.session_state["_compare_result"]
+                result_slot.markdown(result)
 
                 # Quick verdict badge derived from Decision line
-                decision_line = next((ln for ln in result.splitlines() if ln.strip().lower().startswith("decision:")), "")
-                decision = decision_line.split(":", 1)[1].strip() if ":" in decision_line else ""
-                if "IDENTICAL" in decision.upper():
+                decision = compare_decision(result)
+                if decision == "IDENTICAL IN MEANING":
                     st.success("✅ Identical in meaning")
-                elif "MINOR" in decision.upper():
+                elif decision == "MINOR EDITS ONLY":
                     st.info("ℹ️ Minor edits only")
-                elif "SUBSTANTIVE" in decision.upper():
+                elif decision == "SUBSTANTIVE DIFFERENCES":
                     st.warning("⚠️ Substantive differences")
                 else:
                     st.info("Comparison complete")